@@ -9,19 +9,24 @@ SAR
 
 Tools for SAR analysis."""
 
-import base64, pickle, time
+import base64, math, multiprocessing, time
 from io import BytesIO as IO
 import os.path as op
 from collections import Counter
+from concurrent.futures import ProcessPoolExecutor
 from copy import deepcopy
 from dataclasses import dataclass
+from functools import lru_cache, partial
+from types import MethodType
 
 import pandas as pd
 import numpy as np
+from matplotlib import pyplot as plt
+import joblib
+from joblib import Parallel, delayed, effective_n_jobs
 from sklearn.ensemble import RandomForestClassifier
 
-from rdkit.Chem import AllChem as Chem
-from rdkit.Chem import Draw
+from rdkit.Chem import Draw, rdFingerprintGenerator
 from rdkit.Chem.Draw import SimilarityMaps
 from rdkit import DataStructs
 
@@ -31,7 +36,7 @@ try:
 except KeyError:  # Font "DejaVu Sans" is not available
     pass
 
-from mol_frame import mol_frame as mf, mol_images as mi
+from mol_frame import mol_frame as mf
 
 # from typing import List,
 
@@ -93,7 +98,9 @@ class SAR(object):
     """Container class for SAR analysis.
     Operates on a copy of the original MolFrame.
     All methods of the SAR class return copies,
-    except for the `train` method."""
+    except for the `train` method.
+    The model is treated as immutable after training
+    and is shared between the copies."""
 
     def __init__(self, molf: mf.MolFrame = None):
         """
@@ -122,37 +129,71 @@ class SAR(object):
         return result
 
     def __getattr__(self, name):
-        """Try to call undefined methods on the underlying pandas DataFrame."""
+        """Try to call undefined methods on the underlying pandas DataFrame.
+        Frequently used MolFrame attributes are delegated explicitly below."""
+        if name == "molf":  # not yet set, avoid infinite recursion
+            raise AttributeError(name)
+        delegates = self.__dict__.setdefault("_delegates", {})
+        if name in delegates:
+            return MethodType(delegates[name], self)
         if hasattr(self.molf, name):
-
-            def method(*args, **kwargs):
-                res = getattr(self.molf, name)(*args, **kwargs)
+            # cached unbound and bound on access, so that the cache
+            # does not hold a reference cycle to the instance
+            def method(sar, *args, **kwargs):
+                res = getattr(sar.molf, name)(*args, **kwargs)
                 if isinstance(res, mf.MolFrame):
-                    result = self.new()
+                    result = sar.new()
                     result.molf = res
                 else:
                     result = res
                 return result
 
-            return method
+            delegates[name] = method
+            return MethodType(method, self)
         else:
             raise AttributeError
 
-    def new(self):
+    @property
+    def data(self):
+        return self.molf.data
+
+    @data.setter
+    def data(self, value):
+        self.molf.data = value
+
+    @property
+    def use_col(self):
+        return self.molf.use_col
+
+    @use_col.setter
+    def use_col(self, value):
+        self.molf.use_col = value
+
+    def find_mol_col(self):
+        return self.molf.find_mol_col()
+
+    def mol_method(self, x):
+        return self.molf.mol_method(x)
+
+    def new(self, clone=False):
+        """Returns a new, empty SAR instance with the same model.
+        Use `clone=True` to get a deep copy of the model."""
         result = SAR()
-        if self.model is None:
-            result.model = None
-        else:
+        if clone and self.model is not None:
             result.model = deepcopy(self.model)
+        else:
+            result.model = self.model
         return result
 
     def write(self, **kwargs):
         bn = kwargs.get("name", self.config["NAME"])
         self.molf.write_csv(f"{bn}.tsv")
 
-    def copy(self):
+    def copy(self, clone=False):
+        """Returns a copy with the same model.
+        Use `clone=True` to get a deep copy of the model."""
         result = SAR(self.molf)
-        result.model = self.model
+        result.model = deepcopy(self.model) if clone else self.model
         return result
 
     def to_csv(self, fn, sep="\t", index=False):
@@ -160,36 +201,36 @@ class SAR(object):
 
     def analyze(self, act_class="AC_Real", pred_class="AC_Pred"):
         """Prints the ratio of succcessful predictions for the molecules which have `act_class` and `pred_class` properties."""
-        mol_ctr = Counter()
-        hit_ctr = Counter()
-        for _, rec in self.molf.data.iterrows():
-            if act_class in rec and pred_class in rec:
-                mol_ctr[rec[act_class]] += 1
-                if rec[act_class] != rec[pred_class]:
-                    continue
-                hit_ctr[rec[act_class]] += 1
+        df = self.molf.data
+        if act_class in df.columns and pred_class in df.columns:
+            df = df[df[act_class].notna() & df[pred_class].notna()]
+            mol_ctr = df[act_class].value_counts()
+            hit_ctr = df.loc[df[act_class] == df[pred_class], act_class].value_counts()
+            hit_ctr = hit_ctr.reindex(mol_ctr.index, fill_value=0)
+        else:
+            mol_ctr = hit_ctr = pd.Series(dtype=int)
         if len(mol_ctr) > 0:
-            sum_mol_ctr = sum(mol_ctr.values())
-            sum_hit_ctr = sum(hit_ctr.values())
+            sum_mol_ctr = mol_ctr.sum()
+            sum_hit_ctr = hit_ctr.sum()
             print(
                 "Number of correctly predicted molecules: {} / {}    ({:.2f}%)".format(
                     sum_hit_ctr, sum_mol_ctr, 100 * sum_hit_ctr / sum_mol_ctr
                 )
             )
             print("\nCorrectly predicted molecules per Activity Class:")
-            for c in sorted(hit_ctr):
+            for c in sorted(mol_ctr.index):
                 print("  {}:  {:.2f}".format(c, 100 * hit_ctr[c] / mol_ctr[c]))
         else:
             print(
                 "No molecules found with both {} and {}.".format(act_class, pred_class)
             )
-        return hit_ctr, mol_ctr
+        return Counter(hit_ctr[hit_ctr > 0].to_dict()), Counter(mol_ctr.to_dict())
 
-    def save_model(self, fn="sar"):
+    def save_model(self, fn="sar", compress=("zlib", 3)):
         if self.model is None:
             print("No model available.")
             return
-        save_model(self.model, fn)
+        save_model(self.model, fn, compress=compress)
 
     def load_model(self, fn="sar", force=False):
         if self.model is not None and not force:
@@ -197,8 +238,7 @@ class SAR(object):
             return
         if not fn.endswith(".model"):
             fn = fn + ".model"
-        with open(fn, "rb") as f:
-            self.model = pickle.load(f)
+        self.model = joblib.load(fn)
         print(
             "  > model loaded (last modified: {}).".format(
                 time.strftime("%Y-%m-%d %H:%M", time.localtime(op.getmtime(fn)))
@@ -211,6 +251,7 @@ class SAR(object):
         n_est=500,
         rnd_state=1123,
         show_progress=True,
+        backend="sklearn",
         **kwargs,
     ):
         self.model = train(
@@ -219,6 +260,7 @@ class SAR(object):
             n_est=n_est,
             rnd_state=rnd_state,
             show_progress=show_progress,
+            backend=backend,
             **kwargs,
         )
 
@@ -229,27 +271,32 @@ class SAR(object):
         result.molf = predict(self.molf, self.model, threshold=threshold)
         return result
 
-    def add_sim_maps(self):
+    def add_sim_maps(self, n_jobs=1, img_format="png"):
         """Adds the similarity maps as images to the MolFrame.
+        See `add_sim_maps()` for the use of `n_jobs` and `img_format`.
         Returns a copy."""
 
         result = self.copy()
-        result.molf = add_sim_maps(self.molf, self.model)
+        result.molf = add_sim_maps(
+            self.molf, self.model, n_jobs=n_jobs, img_format=img_format
+        )
         return result
 
     def accuracy(self):
         """Returns a namedtuple Accuracy(num, overall, active, inactive, kappa).
+        Only rows with `AC_Real` and `AC_Pred` values of 0 or 1 are counted.
         kappa calculation from P. Czodrowski (https://link.springer.com/article/10.1007/s10822-014-9759-6)"""
         pred = self.molf.data[
-            (self.molf.data["AC_Real"].notna()) & (self.molf.data["AC_Pred"].notna())
-        ].copy()
-        ctr_pred_act = len(pred[pred["AC_Pred"] == 1])
-        ctr_pred_inact = len(pred[pred["AC_Pred"] == 0])
-        # print(ctr_real_act, ctr_real_inact)
-        true_pos = len(pred[(pred["AC_Real"] == 1) & (pred["AC_Pred"] == 1)])
-        true_neg = len(pred[(pred["AC_Real"] == 0) & (pred["AC_Pred"] == 0)])
-        false_pos = len(pred[(pred["AC_Real"] == 0) & (pred["AC_Pred"] == 1)])
-        false_neg = len(pred[(pred["AC_Real"] == 1) & (pred["AC_Pred"] == 0)])
+            (self.molf.data["AC_Real"].isin([0, 1]))
+            & (self.molf.data["AC_Pred"].isin([0, 1]))
+        ]
+        real = pred["AC_Real"].to_numpy(np.int8)
+        predicted = pred["AC_Pred"].to_numpy(np.int8)
+        # counts of (real, predicted): (0, 0), (0, 1), (1, 0), (1, 1)
+        counts = np.bincount(2 * real + predicted, minlength=4)
+        true_neg, false_pos, false_neg, true_pos = (int(x) for x in counts)
+        ctr_pred_act = true_pos + false_pos
+        ctr_pred_inact = true_neg + false_neg
         ctr_num_pred = true_pos + false_pos + true_neg + false_neg
         # print(true_pos, true_neg, false_pos, false_neg)
         acc = (true_pos + true_neg) / ctr_num_pred
@@ -263,12 +310,11 @@ class SAR(object):
         #     / (ctr_num_pred * ctr_num_pred)
         # )
         baseline = (
-            np.matmul([true_neg, false_neg], [true_neg, false_pos])
-            / (ctr_num_pred * ctr_num_pred)
-        ) + (
-            np.matmul([false_pos, true_pos], [false_neg, true_pos])
-            / (ctr_num_pred * ctr_num_pred)
-        )
+            true_neg * true_neg
+            + false_neg * false_pos
+            + false_pos * false_neg
+            + true_pos * true_pos
+        ) / (ctr_num_pred * ctr_num_pred)
         kappa = (acc - baseline) / (1 - baseline)
         result = Accuracy(
             num=ctr_num_pred,
@@ -287,45 +333,33 @@ class SAR(object):
         highlight = kwargs.pop("highlight", False)
         if not highlight:
             return self.molf.write_grid(**kwargs)
-        rec_list = []
-        for _, rec in self.molf.data.iterrows():
-            if rec["Confidence"] == "High":
-                rec[
-                    "Prob"
-                ] = f'<div style="background-color: {COL_GREEN};">{rec["Prob"]}</div>'
-                rec[
-                    "Confidence"
-                ] = f'<div style="background-color: {COL_GREEN};">{rec["Confidence"]}</div>'
-            elif rec["Confidence"] == "Medium":
-                rec[
-                    "Prob"
-                ] = f'<div style="background-color: {COL_YELLOW};">{rec["Prob"]}</div>'
-                rec[
-                    "Confidence"
-                ] = f'<div style="background-color: {COL_YELLOW};">{rec["Confidence"]}</div>'
-            else:
-                rec[
-                    "Prob"
-                ] = f'<div style="background-color: {COL_RED};">{rec["Prob"]}</div>'
-                rec[
-                    "Confidence"
-                ] = f'<div style="background-color: {COL_RED};">{rec["Confidence"]}</div>'
-            if rec["AC_Real"] == rec["AC_Pred"]:
-                rec[
-                    "AC_Real"
-                ] = f'<div style="background-color: {COL_GREEN};">{rec["AC_Real"]}</div>'
-                rec[
-                    "AC_Pred"
-                ] = f'<div style="background-color: {COL_GREEN};">{rec["AC_Pred"]}</div>'
-            else:
-                rec[
-                    "AC_Real"
-                ] = f'<div style="background-color: {COL_RED};">{rec["AC_Real"]}</div>'
-                rec[
-                    "AC_Pred"
-                ] = f'<div style="background-color: {COL_RED};">{rec["AC_Pred"]}</div>'
-            rec_list.append(rec)
-        tmp = mf.MolFrame(pd.DataFrame(rec_list))
+        tmp = self.molf.copy()
+        data = tmp.data
+        color = pd.Series(
+            np.select(
+                [data["Confidence"] == "High", data["Confidence"] == "Medium"],
+                [COL_GREEN, COL_YELLOW],
+                default=COL_RED,
+            ),
+            index=data.index,
+        )
+        ac_color = pd.Series(
+            np.where(data["AC_Real"] == data["AC_Pred"], COL_GREEN, COL_RED),
+            index=data.index,
+        )
+        for col, col_color in [
+            ("Prob", color),
+            ("Confidence", color),
+            ("AC_Real", ac_color),
+            ("AC_Pred", ac_color),
+        ]:
+            data[col] = (
+                '<div style="background-color: '
+                + col_color
+                + ';">'
+                + data[col].astype(str)
+                + "</div>"
+            )
         return tmp.write_grid(truncate=100, **kwargs)
 
 
@@ -336,88 +370,192 @@ def read_csv(name: str) -> SAR:
     return result
 
 
+@lru_cache(maxsize=None)
+def _morgan_generator(radius=2, nbits=2048):
+    """Returns a Morgan fingerprint generator, which is reused for all molecules."""
+    return rdFingerprintGenerator.GetMorganGenerator(radius=radius, fpSize=nbits)
+
+
+def _fp_batch(mols, radius=2, nbits=2048):
+    """Returns the Morgan fingerprints of a sequence of molecules
+    as one bit-packed (n_mols, nbits / 8) uint8 Numpy array."""
+    fp_gen = _morgan_generator(radius, nbits)
+    np_fps = np.empty((len(mols), nbits), dtype=np.uint8)
+    for i, mol in enumerate(mols):
+        np_fps[i] = fp_gen.GetFingerprintAsNumPy(mol)
+    return np.packbits(np_fps, axis=1)
+
+
+def _mol_col_key(molf: mf.MolFrame):
+    """Returns a key for the current content of the mol column,
+    used to invalidate the caches on the MolFrame."""
+    col_hash = pd.util.hash_pandas_object(molf.data[molf.use_col], index=False)
+    return (molf.use_col, hash(col_hash.to_numpy().tobytes()))
+
+
+def _ensure_mols(molf: mf.MolFrame, col_key=None):
+    """Returns the molecules of the MolFrame as Numpy object array.
+    The molecules are cached on the MolFrame (`_mols`), so that e.g. Smiles
+    are only parsed again when the mol column or its content changes.
+    `col_key` is the result of `_mol_col_key()`, if already known.
+    `find_mol_col()` has to be called on the MolFrame first."""
+    key = _mol_col_key(molf) if col_key is None else col_key
+    if getattr(molf, "_mols_key", None) != key:
+        molf._mols = molf.data[molf.use_col].map(molf.mol_method).to_numpy()
+        molf._mols_key = key
+    return molf._mols
+
+
+def _pass_caches(molf: mf.MolFrame, result: mf.MolFrame):
+    """Passes the cached molecules and fingerprints on to a copy of the MolFrame.
+    The caches are keyed on the content of the mol column,
+    so they are only used as long as that is unchanged."""
+    for attr in ("_mols", "_mols_key", "_fp_packed", "_fp_key"):
+        if attr in molf.__dict__:
+            setattr(result, attr, molf.__dict__[attr])
+
+
+def _fps_matrix(molf: mf.MolFrame, radius=2, nbits=2048, n_jobs=-1, col_key=None):
+    """Returns the Morgan fingerprints of all molecules in the MolFrame
+    as one bit-packed (n_mols, nbits / 8) uint8 Numpy array.
+    The molecules are processed in `n_jobs` batches on a thread pool.
+    `find_mol_col()` has to be called on the MolFrame first."""
+    mols = _ensure_mols(molf, col_key=col_key)
+    n_batches = min(effective_n_jobs(n_jobs), len(mols))
+    if n_batches <= 1:
+        return _fp_batch(mols, radius=radius, nbits=nbits)
+    batches = Parallel(n_jobs=n_jobs, prefer="threads")(
+        delayed(_fp_batch)(batch, radius=radius, nbits=nbits)
+        for batch in np.array_split(mols, n_batches)
+    )
+    return np.vstack(batches)
+
+
+def _ensure_fps(molf: mf.MolFrame, radius=2, nbits=2048):
+    """Returns the fingerprint matrix of the MolFrame
+    as (n_mols, nbits) float32 Numpy array, ready for the classifiers.
+    The matrix is cached bit-packed on the MolFrame (`_fp_packed`)
+    and only recalculated when the mol column or its content changes.
+    `find_mol_col()` has to be called on the MolFrame first."""
+    col_key = _mol_col_key(molf)
+    key = (col_key, radius, nbits)
+    if getattr(molf, "_fp_key", None) != key:
+        molf._fp_packed = _fps_matrix(molf, radius=radius, nbits=nbits, col_key=col_key)
+        molf._fp_key = key
+    return np.unpackbits(molf._fp_packed, axis=1, count=nbits).astype(np.float32)
+
+
 def train(
     molf: mf.MolFrame,
     act_class="AC_Real",
     n_est=500,
     rnd_state=1123,
     show_progress=True,
+    backend="sklearn",
     **kwargs,
 ):
     """Returns the trained model.
-    The kwargs are passed to sklearn' s RandomForestClassifier constructor."""
-    fps = []
-    act_classes = []
+    The kwargs are passed to the classifier constructor of the chosen backend.
+
+    Parameters:
+        backend: "sklearn" (default), "lightgbm" or "cuml".
+            "sklearn": the kwargs go to sklearn's RandomForestClassifier.
+                The forest is trained and used for prediction on all cores
+                by default, pass e.g. `n_jobs=1` to override.
+            "lightgbm": trains a histogram-based random forest with LightGBM,
+                which is much faster on the binary fingerprint bits.
+                The kwargs go to LGBMClassifier and override the defaults
+                `boosting_type="rf"`, `subsample=0.8`, `subsample_freq=1`,
+                `colsample_bytree=0.5`, `max_bin=2` and `n_jobs=-1`.
+            "cuml": trains the forest on the GPU with RAPIDS cuML,
+                which pays off for large data sets (> 100k molecules).
+                The kwargs go to cuml.ensemble.RandomForestClassifier.
+                The similarity maps of cuML models are generated in-process."""
+    if backend not in ("sklearn", "lightgbm", "cuml"):
+        raise ValueError(f"Unknown backend: {backend}")
     molf.find_mol_col()
     if show_progress:
         print("  [TRAIN] calculating fingerprints")
-    for _, rec in molf.data.iterrows():
-        fps.append(
-            Chem.GetMorganFingerprintAsBitVect(molf.mol_method(rec[molf.use_col]), 2)
-        )
-        act_classes.append(rec[act_class])
-    np_fps = []
-    if show_progress:
-        print("  [TRAIN] calculating Numpy arrays")
-    for fp in fps:
-        arr = np.zeros((1,))
-        DataStructs.ConvertToNumpyArray(fp, arr)
-        np_fps.append(arr)
+    np_fps = _ensure_fps(molf)
+    act_classes = molf.data[act_class].to_numpy()
 
-    # get a random forest classifiert with 100 trees
     if show_progress:
-        print("  [TRAIN] training RandomForestClassifier")
-    rf = RandomForestClassifier(n_estimators=n_est, random_state=rnd_state, **kwargs)
-    rf.fit(np_fps, act_classes)
+        print(f"  [TRAIN] training RandomForestClassifier ({backend})")
+    if backend == "cuml":
+        import cupy as cp
+        from cuml.ensemble import RandomForestClassifier as CumlRandomForest
+
+        rf = CumlRandomForest(n_estimators=n_est, random_state=rnd_state, **kwargs)
+        rf.fit(
+            cp.asarray(np_fps),
+            cp.asarray(act_classes, dtype=cp.int32),
+        )
+    elif backend == "lightgbm":
+        from lightgbm import LGBMClassifier
+        from scipy.sparse import csr_matrix
+
+        params = dict(
+            boosting_type="rf",
+            subsample=0.8,
+            subsample_freq=1,
+            colsample_bytree=0.5,
+            max_bin=2,
+            n_jobs=-1,
+        )
+        params.update(kwargs)
+        rf = LGBMClassifier(n_estimators=n_est, random_state=rnd_state, **params)
+        rf.fit(csr_matrix(np_fps), act_classes)
+    else:
+        kwargs.setdefault("n_jobs", -1)
+        rf = RandomForestClassifier(
+            n_estimators=n_est, random_state=rnd_state, **kwargs
+        )
+        rf.fit(np_fps, act_classes)
     if show_progress:
         print("  [TRAIN] done.")
     return rf
 
 
-def predict(molf: mf.MolFrame, model, threshold=0.5):
-    def _predict_mol(mol):
-        """Returns the predicted class and the probabilities for a molecule.
+def _is_cuml(model):
+    return type(model).__module__.startswith("cuml")
 
-        Parameters:
-            model: Output from `train()`."""
-        fp = np.zeros((1,))
-        DataStructs.ConvertToNumpyArray(Chem.GetMorganFingerprintAsBitVect(mol, 2), fp)
-        fp = fp.reshape(1, -1)  # this removes the deprecation warning
-        # predict_class = model.predict(fp)
-        predict_prob = model.predict_proba(fp)
-        # return predict_class[0], predict_prob[0][1])
-        proba = round(predict_prob[0][1], 2)
-        if proba > threshold:
-            return 1, proba
-        else:
-            return 0, proba
 
-    def _predict(s):
-        mol = molf.mol_method(s[molf.use_col])
-        result = _predict_mol(mol)
-        return result  # returns tuple
+def predict(molf: mf.MolFrame, model, threshold=0.5):
+    """Returns a copy of the MolFrame with the predicted class (`AC_Pred`),
+    the probability (`Prob`) and the `Confidence` of the prediction.
 
+    Parameters:
+        model: Output from `train()`."""
     molf.find_mol_col()
     result = molf.copy()
-    result.data[["AC_Pred", "Prob"]] = result.data.apply(
-        _predict, axis=1, result_type="expand"
+    proba = np.asarray(model.predict_proba(_ensure_fps(molf)))[:, 1].round(2)
+    _pass_caches(molf, result)
+    result.data["AC_Pred"] = (proba > threshold).astype(int)
+    result.data["Prob"] = proba
+    conf_codes = np.select(
+        [
+            (proba < 0.4 * threshold) | (proba > 1.6 * threshold),
+            (proba < 0.8 * threshold) | (proba > 1.2 * threshold),
+        ],
+        [2, 1],
+        default=0,
+    )
+    result.data["Confidence"] = pd.Categorical.from_codes(
+        conf_codes, categories=["Low", "Medium", "High"], ordered=True
     )
-    result.data["AC_Pred"] = result.data["AC_Pred"].astype(int)
-    result["Confidence"] = "Low"
-    result["Confidence"].loc[
-        (result["Prob"] < (0.8 * threshold)) | (result["Prob"] > (1.2 * threshold))
-    ] = "Medium"
-    result["Confidence"].loc[
-        (result["Prob"] < (0.4 * threshold)) | (result["Prob"] > (1.6 * threshold))
-    ] = "High"
     return result
 
 
-def save_model(model, fn="sar"):
+def save_model(model, fn="sar", compress=("zlib", 3)):
+    """Saves the model with joblib.
+
+    Parameters:
+        compress: Passed to `joblib.dump`. The default zlib compression
+            can be loaded everywhere. E.g. ("lz4", 3) is faster, but requires
+            the lz4 package when saving *and* when loading the model."""
     if not fn.endswith(".model"):
         fn = fn + ".model"
-    with open(fn, "wb") as f:
-        pickle.dump(model, f)
+    joblib.dump(model, fn, compress=compress)
 
 
 def read_sdf(fn, model_name=None):
@@ -436,46 +574,111 @@ def read_sdf(fn, model_name=None):
     return sarf
 
 
-def b64_fig(fig, dpi=72):
+def b64_fig(fig, dpi=72, img_format="png"):
+    """Returns the figure as base64 encoded image string.
+    The figure is trimmed by matplotlib (`bbox_inches="tight"`) and encoded once.
+    Other formats than "png", e.g. "webp", give smaller images."""
     img_file = IO()
-    # print(fig.savefig.__doc__)
-    # print([x for x in dir(fig) if x.startswith("set_")])
-    # print(sorted(dir(fig)))
-    # print(fig.get_edgecolor(), fig.get_facecolor())
-    fig.savefig(img_file, dpi=dpi, format="PNG", bbox_inches="tight")
-    img = mi.Image.open(img_file)
-    img = mi.autocrop(img)
-    img_file.close()
-    img_file = IO()
-    img.save(img_file, format="PNG")
+    fig.savefig(
+        img_file, dpi=dpi, format=img_format, bbox_inches="tight", pad_inches=0
+    )
     b64 = base64.b64encode(img_file.getvalue())
     b64 = b64.decode()
     img_file.close()
     return b64
 
 
-def _get_proba(fp, predictionFunction):
-    result = predictionFunction([fp])
-    return result[0][1]
+def _atomic_weights(mol, model, nbits=2048):
+    """Returns the atomic weights of the molecule for the similarity map,
+    like `SimilarityMaps.GetAtomicWeightsForModel`, but with one batched
+    `predict_proba` call for the molecule and all its atom perturbations."""
+    fps = []
 
+    def _collect_fp(fp):
+        fps.append(fp)
+        return 0.0
+
+    # only used to generate the perturbed fingerprints in the same way as RDKit
+    SimilarityMaps.GetAtomicWeightsForModel(
+        mol,
+        lambda m, atom_id: SimilarityMaps.GetMorganFingerprint(
+            m, atom_id, nBits=nbits
+        ),
+        _collect_fp,
+    )
+    np_fps = np.empty((len(fps), nbits), dtype=np.float32)
+    for i, fp in enumerate(fps):
+        DataStructs.ConvertToNumpyArray(fp, np_fps[i])
+    proba = np.asarray(model.predict_proba(np_fps))[:, 1]
+    return (proba[0] - proba[1:]).tolist()
+
+
+# The model used by the similarity map worker processes,
+# set by `_init_sim_map_worker`.
+_SIM_MAP_MODEL = None
+
+
+def _init_sim_map_worker(model):
+    global _SIM_MAP_MODEL
+    _SIM_MAP_MODEL = model
+    if hasattr(model, "n_jobs"):
+        # the workers already run in parallel
+        _SIM_MAP_MODEL.n_jobs = 1
+
+
+def _sim_map(mol, model=None, img_format="png"):
+    """Returns the similarity map of the molecule as HTML img tag.
+    Runs in a worker process of `add_sim_maps`, which uses the worker's model,
+    or in-process with the given `model`."""
+    if model is None:
+        model = _SIM_MAP_MODEL
+    weights = _atomic_weights(mol, model)
+    weights, _ = SimilarityMaps.GetStandardizedWeights(weights)
+    fig = SimilarityMaps.GetSimilarityMapFromWeights(mol, weights, linewidths=0)
+    b64 = b64_fig(fig, dpi=72, img_format=img_format)
+    plt.close(fig)
+    img_src = '<img src="data:image/{};base64,{}" alt="Map" />'.format(
+        img_format, b64
+    )
+    return img_src
 
-def add_sim_maps(molf: mf.MolFrame, model):
+
+def add_sim_maps(molf: mf.MolFrame, model, n_jobs=1, img_format="png"):
     """Adds the similarity maps as images to the MolFrame.
-    Returns a copy."""
-
-    def _map(x):
-        mol = molf.mol_method(x)
-        fig, _ = SimilarityMaps.GetSimilarityMapForModel(
-            mol,
-            SimilarityMaps.GetMorganFingerprint,
-            lambda y: _get_proba(y, model.predict_proba),
-            linewidths=0,
-        )
-        b64 = b64_fig(fig, dpi=72)
-        img_src = '<img src="data:image/png;base64,{}" alt="Map" />'.format(b64)
-        return img_src
+    Returns a copy.
+
+    Parameters:
+        img_format: Image format of the maps, "png" (default) or e.g. "webp",
+            which gives smaller images.
+        n_jobs: Number of worker processes for generating the maps,
+            -1 uses all cores. Default is 1 (no worker processes).
+            The workers are started with the "spawn" method, which re-runs
+            the top-level code of the calling script, so scripts have to
+            guard it with `if __name__ == "__main__":`.
+            Each worker gets its own copy of the model.
+            Small MolFrames and GPU (cuML) models always use this process."""
 
     molf.find_mol_col()
     result = molf.copy()
-    result.data["Map"] = result.data[molf.use_col].apply(_map)
+    mols = _ensure_mols(molf).tolist()
+    _pass_caches(molf, result)
+    chunksize = 8
+    n_workers = min(effective_n_jobs(n_jobs), math.ceil(len(mols) / chunksize))
+    # the CUDA context of cuML models can not be shared with worker processes
+    if n_workers <= 1 or _is_cuml(model):
+        result.data["Map"] = [_sim_map(mol, model, img_format) for mol in mols]
+        return result
+    # spawn instead of fork: the model's native libraries (e.g. OpenMP)
+    # can not be used safely in a forked child
+    with ProcessPoolExecutor(
+        max_workers=n_workers,
+        mp_context=multiprocessing.get_context("spawn"),
+        initializer=_init_sim_map_worker,
+        initargs=(model,),
+    ) as executor:
+        result.data["Map"] = list(
+            executor.map(
+                partial(_sim_map, img_format=img_format), mols, chunksize=chunksize
+            )
+        )
     return result